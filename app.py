@@ -3,6 +3,7 @@ import pandas as pd
 import os
 import sys # Import sys to get executable path
 import logging # Import logging
+import hashlib
 
 # Configure logging
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -10,14 +11,12 @@ logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %
 logging.debug("--- app.py execution started ---")
 logging.debug(f"Python executable: {sys.executable}")
 logging.debug(f"Streamlit version: {st.__version__}")
-logging.debug(f"Type of st object: {type(st)}")
-logging.debug(f"Attributes in st: {dir(st)}")
 
 # Removed unused imports: re, json, google.genai, google.genai.types, io.BytesIO, base64, tempfile, shutil
 
 # Import functions and classes from new modules
-from gemini_service import run_gemini_extraction
-from sku_processing import preprocess_data, generate_comparison_table, normalize_sku_names # Added normalize_sku_names
+from gemini_service import run_gemini_extraction_batches
+from sku_processing import preprocess_data, generate_comparison_table, get_supplier_unique_sku_counts, normalize_sku_names, RAW_ITEM_COLUMNS # Added normalize_sku_names
 from ui_components import (
     render_file_uploader,
     render_sku_selector,
@@ -27,29 +26,61 @@ from ui_components import (
     render_raw_data_expander,
     render_footer,
 )
-from models import ProcessedSkuItem # Import ProcessedSkuItem for type hinting if needed, or just for clarity
 import instructor
 from openai import OpenAI # For instructor client
+from typing import Optional
 
 # --- Initialize Chutes AI Instructor Client ---
-# Attempt to get API key from Streamlit secrets, then environment variable
-CHUTES_API_KEY = st.secrets.get("CHUTES_API_KEY", os.environ.get("CHUTES_API_KEY"))
-chutes_instructor_client = None
-if CHUTES_API_KEY:
+@st.cache_resource
+def get_chutes_client() -> Optional[instructor.Instructor]:
+    """
+    Builds the Chutes AI instructor client once per process instead of on every rerun.
+    Returns None if no API key is configured or initialization fails.
+    """
+    # Attempt to get API key from Streamlit secrets, then environment variable
+    chutes_api_key = st.secrets.get("CHUTES_API_KEY", os.environ.get("CHUTES_API_KEY"))
+    if not chutes_api_key:
+        logging.warning("CHUTES_API_KEY not found in Streamlit secrets or environment variables. SKU normalization will be skipped.")
+        return None
     try:
-        chutes_instructor_client = instructor.from_openai(
+        client = instructor.from_openai(
             OpenAI(
                 base_url="https://openrouter.ai/api/v1",
-                api_key=CHUTES_API_KEY,
+                api_key=chutes_api_key,
                 timeout=30.0, # Added timeout
+                max_retries=3, # The SDK retries 429/5xx with exponential backoff and honours Retry-After
             )
         )
         logging.info("Chutes AI Instructor client initialized successfully.")
+        return client
     except Exception as e:
         logging.error(f"Failed to initialize Chutes AI Instructor client: {e}")
-        # chutes_instructor_client will remain None, app can proceed without normalization if client is None
-else:
-    logging.warning("CHUTES_API_KEY not found in Streamlit secrets or environment variables. SKU normalization will be skipped.")
+        # App can proceed without normalization if the client is None
+        return None
+
+
+@st.cache_data(persist="disk", max_entries=32, show_spinner=False)
+def preprocess_extracted_data(extracted_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Cached preprocess_data, keyed by the extracted items' content, so re-extracting the same files
+    (served from the Gemini extraction cache) also reuses the processed table.
+    Each call returns its own copy, so normalizing it in place doesn't touch the cached value.
+    """
+    return preprocess_data(extracted_df)
+
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def build_comparison_table(
+    selected_sku_names: tuple,
+    processed_df: pd.DataFrame,
+    suppliers: tuple,
+    supplier_unique_counts: dict,
+) -> pd.DataFrame:
+    """
+    Cached generate_comparison_table, so resubmitting a selection that was already compared
+    reuses the earlier table instead of rebuilding it. Arguments are tuples/dicts so they hash cheaply.
+    """
+    return generate_comparison_table(list(selected_sku_names), processed_df, list(suppliers), supplier_unique_counts or None)
 
 
 # --- Streamlit App UI ---
@@ -57,26 +88,37 @@ st.set_page_config(layout="wide")
 st.title("📄 SKU Quotation Comparator using Gemini AI ✨")
 
 # Initialize session state
-if 'extracted_data' not in st.session_state:
-    st.session_state.extracted_data = None # Raw data from Gemini (list of dicts)
-if 'processed_items' not in st.session_state:
-    st.session_state.processed_items = [] # List of ProcessedSkuItem objects
+if 'extracted_df' not in st.session_state:
+    st.session_state.extracted_df = None # Raw data from Gemini, one row per extracted item
+if 'processed_df' not in st.session_state:
+    st.session_state.processed_df = pd.DataFrame() # One row per processed item (ProcessedSkuItem columns)
 if 'all_sku_names' not in st.session_state:
     st.session_state.all_sku_names = [] # List of unique sku_name strings
 if 'selected_sku_names' not in st.session_state:
     st.session_state.selected_sku_names = [] # List of selected sku_name strings
 if 'comparison_df' not in st.session_state:
     st.session_state.comparison_df = pd.DataFrame()
+if 'supplier_unique_counts' not in st.session_state:
+    st.session_state.supplier_unique_counts = {} # Unique raw SKU codes per supplier, computed once per extraction
 
 # --- Handlers for UI component interactions ---
 
 def handle_extract_data(uploaded_files):
     """Handles the data extraction process when the button is clicked."""
-    st.session_state.extracted_data = None # Reset previous
-    st.session_state.processed_items = []
+    st.session_state.extracted_df = None # Reset previous
+    st.session_state.processed_df = pd.DataFrame()
     st.session_state.all_sku_names = []
     st.session_state.selected_sku_names = []
     st.session_state.comparison_df = pd.DataFrame()
+    st.session_state.supplier_unique_counts = {}
+
+    # Byte-identical uploads would be extracted (and compared) twice; keep the first copy of each
+    unique_files = {}
+    for uploaded_file in uploaded_files:
+        unique_files.setdefault(hashlib.file_digest(uploaded_file, "sha256").hexdigest(), uploaded_file)
+    if len(unique_files) < len(uploaded_files):
+        st.info(f"Skipping {len(uploaded_files) - len(unique_files)} duplicate file(s).")
+    uploaded_files = list(unique_files.values())
 
     all_extracted_data = []
     batch_size = 3
@@ -88,44 +130,57 @@ def handle_extract_data(uploaded_files):
 
     st.info(f"Processing {num_files} files in batches of {batch_size}...")
 
-    for i in range(0, num_files, batch_size):
-        batch_files = uploaded_files[i : i + batch_size]
-        batch_number = (i // batch_size) + 1
-        st.write(f"Processing batch {batch_number} with {len(batch_files)} files...")
+    # Batches are extracted concurrently; one progress bar is updated in place as they finish
+    batches = [uploaded_files[i : i + batch_size] for i in range(0, num_files, batch_size)]
+    num_batches = len(batches)
+    progress_bar = st.progress(0.0, text=f"Processing {num_batches} batches...")
+    finished_batches = 0
+
+    def on_batch_done(batch_index):
+        nonlocal finished_batches
+        finished_batches += 1
+        progress_bar.progress(finished_batches / num_batches, text=f"Processed {finished_batches} of {num_batches} batches.")
 
-        extracted_json_data = run_gemini_extraction(batch_files)
+    batch_results = run_gemini_extraction_batches(batches, on_batch_done)
 
+    empty_batches = []
+    for batch_number, extracted_json_data in enumerate(batch_results, start=1):
         if extracted_json_data:
             all_extracted_data.extend(extracted_json_data)
-            st.success(f"Successfully extracted data for {len(extracted_json_data)} items from batch {batch_number}.")
+            logging.info(f"Extracted {len(extracted_json_data)} items from batch {batch_number}.")
         else:
-            st.warning(f"No data extracted from batch {batch_number}.")
+            empty_batches.append(batch_number)
+
+    if empty_batches:
+        st.warning(f"No data extracted from batch(es) {', '.join(map(str, empty_batches))}.")
 
     if all_extracted_data:
-        st.session_state.extracted_data = all_extracted_data
+        # Keep the raw items column-wise rather than as a list of dicts
+        st.session_state.extracted_df = pd.DataFrame(all_extracted_data, columns=RAW_ITEM_COLUMNS)
         st.success(f"Successfully extracted data for a total of {len(all_extracted_data)} items from all files!")
 
         # Preprocess and populate unique SKU names for selection
-        processed_items = preprocess_data(st.session_state.extracted_data)
-        if processed_items:
-            st.session_state.processed_items = processed_items
+        processed_df = preprocess_extracted_data(st.session_state.extracted_df)
+        if not processed_df.empty:
+            st.session_state.processed_df = processed_df
+            # Depends only on supplier and raw SKU code, so normalization below doesn't change it
+            st.session_state.supplier_unique_counts = get_supplier_unique_sku_counts(processed_df)
             
             # --- SKU Name Normalization Step ---
-            if chutes_instructor_client and st.session_state.processed_items:
-                current_sku_names = sorted(list(set(item.sku_name for item in st.session_state.processed_items)))
+            chutes_instructor_client = get_chutes_client()
+            if chutes_instructor_client:
+                current_sku_names = sorted(processed_df["sku_name"].unique())
                 if current_sku_names:
                     st.write("Normalizing SKU names via Chutes AI...") # User feedback
                     try:
                         normalized_name_map = normalize_sku_names(current_sku_names, chutes_instructor_client)
 
                         if normalized_name_map:
-                            updated_items_count = 0
-                            for item in st.session_state.processed_items:
-                                original_name = item.sku_name
-                                normalized_name = normalized_name_map.get(original_name, original_name)
-                                if original_name != normalized_name:
-                                    item.sku_name = normalized_name
-                                    updated_items_count +=1
+                            # One vectorized lookup; names without a mapping keep their original value
+                            original_names = processed_df["sku_name"]
+                            normalized_names = original_names.map(normalized_name_map).fillna(original_names)
+                            updated_items_count = int((normalized_names != original_names).sum())
+                            processed_df["sku_name"] = normalized_names.astype("category")
                             if updated_items_count > 0:
                                 st.success(f"SKU names normalized. {updated_items_count} items updated.")
                             else:
@@ -137,12 +192,12 @@ def handle_extract_data(uploaded_files):
                         logging.error(f"SKU Normalization Exception: {e}", exc_info=True)
                 else:
                     logging.info("No SKU names found in processed items to normalize.")
-            elif not chutes_instructor_client:
+            else:
                 st.warning("Chutes AI client not initialized (CHUTES_API_KEY missing?). Skipping SKU name normalization.")
             # --- End SKU Name Normalization ---
 
             # Update all_sku_names and selected_sku_names with the new (potentially normalized) names
-            unique_sku_names = sorted(list(set(item.sku_name for item in st.session_state.processed_items)))
+            unique_sku_names = sorted(processed_df["sku_name"].unique())
             st.session_state.all_sku_names = unique_sku_names
             # Preselect all SKUs after extraction/normalization
             st.session_state.selected_sku_names = unique_sku_names.copy() # Ensure this is a copy
@@ -151,30 +206,31 @@ def handle_extract_data(uploaded_files):
     else:
         st.error("Failed to extract data using Gemini or no data returned from any batch.")
 
-def handle_generate_comparison():
-    """Handles the comparison table generation when the button is clicked."""
-    if st.session_state.extracted_data:
+def handle_generate_comparison(selected_sku_names):
+    """Handles the comparison table generation when the SKU form is submitted."""
+    st.session_state.selected_sku_names = selected_sku_names
+    if st.session_state.extracted_df is not None:
         # Use the already processed items from session state
-        processed_items = st.session_state.processed_items
-        selected_sku_names = st.session_state.selected_sku_names
+        processed_df = st.session_state.processed_df
 
-        if processed_items and selected_sku_names:
+        if not processed_df.empty and selected_sku_names:
             # Determine dynamic supplier order for columns based on all processed items
-            unique_suppliers = sorted(list(set(item.supplier for item in processed_items)))
+            unique_suppliers = sorted(processed_df["supplier"].unique())
             if not unique_suppliers:
                  st.warning("No suppliers found in the processed data.")
                  st.session_state.comparison_df = pd.DataFrame()
             else:
-                st.session_state.comparison_df = generate_comparison_table(
-                    selected_sku_names,
-                    processed_items,
-                    unique_suppliers # Dynamic supplier order
+                st.session_state.comparison_df = build_comparison_table(
+                    tuple(selected_sku_names),
+                    processed_df,
+                    tuple(unique_suppliers), # Dynamic supplier order
+                    st.session_state.supplier_unique_counts,
                 )
                 if st.session_state.comparison_df.empty:
                     st.warning("No data to display for the selected SKUs.")
                 else:
                     st.success("Comparison table generated!")
-        elif not processed_items:
+        elif processed_df.empty:
              st.error("No data available after preprocessing. Cannot generate comparison.")
              st.session_state.comparison_df = pd.DataFrame()
         elif not selected_sku_names:
@@ -192,23 +248,22 @@ with st.sidebar:
     # Store uploaded files in session state if needed for re-runs, though Streamlit handles this
     # st.session_state.uploaded_files = uploaded_files # Optional: Streamlit's file_uploader handles state
 
-    # Render SKU selector if data is available
+    # Render SKU selector if data is available. Inside a form, selection edits don't rerun the
+    # script; the selection is applied and the table rebuilt only when the form is submitted.
     if st.session_state.all_sku_names:
-        st.session_state.selected_sku_names = render_sku_selector(
-            st.session_state.all_sku_names,
-            st.session_state.selected_sku_names,
-            lambda skus: st.session_state.update(selected_sku_names=skus) # Update session state on selection change
-        )
-
-        # Render comparison button if SKUs are selected
-        if st.session_state.selected_sku_names:
-            render_comparison_button(handle_generate_comparison)
+        with st.form("sku_form"):
+            new_selected_sku_names = render_sku_selector(
+                st.session_state.all_sku_names,
+                st.session_state.selected_sku_names,
+                lambda skus: st.session_state.update(selected_sku_names=skus) # Update session state on selection change
+            )
+            render_comparison_button(lambda: handle_generate_comparison(new_selected_sku_names))
 
 
 # --- Main Area ---
 
 # Display warnings if extraction yielded no processable SKUs
-if st.session_state.extracted_data is not None and not st.session_state.all_sku_names and not uploaded_files:
+if st.session_state.extracted_df is not None and not st.session_state.all_sku_names and not uploaded_files:
      st.warning("Data was extracted by Gemini, but no SKUs could be identified for selection. Please check the raw data below or try with different/clearer PDFs.")
 
 # Render the comparison table if available
@@ -218,7 +273,7 @@ render_comparison_table(st.session_state.comparison_df)
 render_notes()
 
 # Display raw data expander
-render_raw_data_expander(st.session_state.extracted_data)
+render_raw_data_expander(st.session_state.extracted_df)
 
 # Display footer
 render_footer()
\ No newline at end of file
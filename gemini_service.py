@@ -1,13 +1,33 @@
 import streamlit as st
 import os
 import json
-import tempfile
 import shutil
 from google import genai
 from google.genai import types
+from google.genai import errors as genai_errors
 from io import BytesIO
 import base64 # Although not directly used in the moved code, it was in the original block, keeping for now.
 import logging
+import hashlib
+import ijson
+import asyncio
+from datetime import datetime, timedelta, timezone
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from typing import List
+from pydantic import ConfigDict, TypeAdapter, ValidationError
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_exponential
+from models import RawSkuItem
+
+# Prefer orjson for the buffered JSON parse when it is installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _JSONDecodeError = orjson.JSONDecodeError
+except ImportError:
+    _json_loads = json.loads
+    _JSONDecodeError = json.JSONDecodeError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,122 +39,273 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 if "GEMINI_API_KEY" in st.secrets:
     os.environ["GEMINI_API_KEY"] = st.secrets["GEMINI_API_KEY"]
 
+# Upper bounds on uploads and on extraction batches in flight at once
+MAX_CONCURRENT_UPLOADS = 8
+MAX_CONCURRENT_BATCHES = 4
+
+# Uploaded files expire on Gemini's side; don't reuse one that is about to
+FILE_REUSE_MARGIN = timedelta(minutes=10)
+
+class _GeminiByteStream:
+    """
+    Minimal async file-like adapter over a Gemini response stream so ijson can parse
+    the JSON incrementally while chunks are still arriving.
+    The raw text is kept for the buffered fallback parse and error diagnostics.
+    """
+    def __init__(self, response_chunks):
+        self._chunks = aiter(response_chunks)
+        self._buffer = b""
+        self.text_parts = []
+
+    async def read(self, size=-1):
+        # Wait only until some data is available; ijson treats b"" as end of stream.
+        while not self._buffer:
+            chunk = await anext(self._chunks, None)
+            if chunk is None:
+                return b""
+            if chunk.text:
+                self.text_parts.append(chunk.text)
+                self._buffer = chunk.text.encode("utf-8")
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    async def read_remaining_text(self):
+        """Consumes the rest of the stream and returns the full response text."""
+        async for chunk in self._chunks:
+            if chunk.text:
+                self.text_parts.append(chunk.text)
+        self._buffer = b""
+        return "".join(self.text_parts)
+
+# Local check of Gemini's output; numbers are accepted for the text-only fields
+_RAW_SKU_ITEMS = TypeAdapter(List[RawSkuItem], config=ConfigDict(coerce_numbers_to_str=True))
+
+class GeminiResponseError(Exception):
+    """Raised when the Gemini response cannot be decoded. Keeps the raw text for display."""
+    def __init__(self, message, response_text):
+        super().__init__(message)
+        self.response_text = response_text
+
+# --- Retries for transient Gemini errors ---
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+_exponential_wait = wait_exponential(multiplier=1, max=30)
+
+def _is_retryable(e):
+    """Rate limits and server-side errors are worth retrying; anything else fails the batch right away."""
+    return isinstance(e, genai_errors.APIError) and e.code in RETRYABLE_STATUS_CODES
+
+def _retry_wait(retry_state):
+    """Honours a Retry-After header when Gemini sends one, otherwise backs off exponentially."""
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = getattr(response, "headers", {}).get("Retry-After")
+    try:
+        return min(float(retry_after), 30)
+    except (TypeError, ValueError):
+        return _exponential_wait(retry_state)
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=_retry_wait,
+    stop=stop_after_attempt(3),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+    reraise=True,
+)
+async def _generate_with_retry(client, model, contents, config):
+    """Starts the streamed generation, retrying on rate limits and transient server errors."""
+    return await client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+
+# --- Gemini request constants, built once at import ---
+_PROMPT_PART = types.Part.from_text(text="""These are PDF quotation files received by a company.
+                              \nInstructions:\n
+                              1. For each distinct product item listed in these documents, extract the following details.\n
+                              2. The 'sku_supplier' should be the name of the company providing the quotation (e.g., NARSINGH PHARMA, MEDIVISION, S. D. M. AGENCY), not the medicine manufacturer like Alembic, Cipla, etc.\n
+                              3. Extract the product name as 'sku_name' (e.g., PARACETAMOL 500MG TAB). \n
+                              If there are product names across the quotations with similar product names, they should be given a common sku_name and used in the output\
+                              Ex: (i) "GLUCONORM G 1" and "GLUCONORM G1" are the same product \n
+                                  (ii) "JANUMET 50/500" and "JANUMET 50/500 TAB" are the same product\n
+                                  (iii) "JUST TEAR E/D" and "JUST TEAR LUBRICANT E/D" are the same product\n
+                                  (iv) "SEROFLO 250 R/C", "SEROFLO 250 ROTA" and "SEROFLO 250 ROTACAP" are the same product\n
+                                  (v) "ATORVA 20MG TAB" and "ATORVA-20" are the same product\n
+                              etc.\n
+                              4. Ensure all numeric fields like MRP, Base Rate, and Discount are extracted as strings, exactly as they appear.\n
+                              5. Extract the paid quantity as an integer in the 'paid_qty' field.\n
+                              6. Extract the free quantity as an integer in the 'free_qty' field.\n
+                              7. If a product appears in multiple documents, create a separate entry for each instance.\n
+                              8. Extract the batch number for each item. This is typically labeled "Batch" and may look like "IAK0040", "24491211", or "JT-2412".\n
+                              9. Extract the total price for the listed quantity of the SKU as an integer in the 'amount' field.\n
+                              Return a single JSON object of the form {"sku_data": [{...}, ...]} where each item has the keys
+                              'sku_supplier', 'sku_invoice', 'sku_name', 'mrp', 'base_rate', 'base_discount_percent' (strings),
+                              'paid_qty', 'free_qty' (integers), 'batch_number' (string) and 'amount' (integer).""")
+
+# No response_schema: schema-constrained generation is slower on Gemini's side, and the
+# response is checked locally against RawSkuItem instead (see _validate_sku_data).
+_GENERATE_CONTENT_CONFIG = types.GenerateContentConfig(
+    response_mime_type="application/json",
+)
+
 # --- Gemini Data Extraction Function ---
-def run_gemini_extraction(uploaded_files):
+async def _upload_file(client, upload_slots, file_name, mime_type, file_bytes):
+    """Uploads a single file to Gemini and returns its (uri, mime_type, expiration_time)."""
+    async with upload_slots:
+        gemini_file = await client.aio.files.upload(
+            file=BytesIO(file_bytes),
+            config=types.UploadFileConfig(mime_type=mime_type, display_name=file_name),
+        )
+    logging.info(f"Uploaded {file_name} to Gemini.")
+    return gemini_file.uri, gemini_file.mime_type, gemini_file.expiration_time
+
+def _is_file_reusable(cached_file):
+    """An uploaded file can be referenced again until Gemini expires it."""
+    _, _, expiration_time = cached_file
+    return expiration_time is None or expiration_time > datetime.now(timezone.utc) + FILE_REUSE_MARGIN
+
+async def _extract_sku_data_async(client, file_hashes, files, file_cache):
     """
     Uploads files to Gemini, sends them for processing, and returns structured SKU data.
-    Returns a list of dictionaries representing raw SKU data, or None on failure.
+    Files already uploaded in this session (same content hash) reuse their Gemini URI;
+    the remaining uploads are all in flight at once, and the streamed response is parsed as it arrives.
     """
-    if not uploaded_files:
-        return None
+    new_files = [
+        (file_hash, file) for file_hash, file in zip(file_hashes, files)
+        if file_hash not in file_cache or not _is_file_reusable(file_cache[file_hash])
+    ]
+    upload_slots = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    uploaded = await asyncio.gather(*(_upload_file(client, upload_slots, *file) for _, file in new_files))
+    for (file_hash, _), cached_file in zip(new_files, uploaded):
+        file_cache[file_hash] = cached_file
+    logging.info(f"Reused {len(files) - len(new_files)} previously uploaded file(s).")
+
+    file_uris_for_prompt = [
+        types.Part.from_uri(file_uri=file_cache[file_hash][0], mime_type=file_cache[file_hash][1])
+        for file_hash in file_hashes
+    ]
 
+    # Prepare prompt parts
+    prompt_parts = [*file_uris_for_prompt, _PROMPT_PART]
+
+    response_stream = _GeminiByteStream(await _generate_with_retry(
+        client,
+        model="gemini-2.0-flash",
+        contents=[types.Content(role="user", parts=prompt_parts)],
+        config=_GENERATE_CONTENT_CONFIG,
+    ))
+    try:
+        # Parse SKU items as they stream in instead of buffering the whole response
+        sku_data = [item async for item in ijson.items(response_stream, "sku_data.item", use_float=True)]
+        if sku_data:
+            logging.info("Successfully decoded streamed JSON response from Gemini.")
+            return _validate_sku_data(sku_data, response_stream)
+        # Nothing under "sku_data": the model may have answered with a different layout, re-check it buffered
+        response_text = await response_stream.read_remaining_text()
+    except ijson.JSONError as e:
+        logging.warning(f"Incremental JSON parsing failed, falling back to a buffered parse: {e}")
+        response_text = await response_stream.read_remaining_text()
+
+    # Try to parse the JSON output
+    try:
+        json_data = _json_loads(response_text)
+        logging.info("Successfully decoded JSON response from Gemini.")
+    except _JSONDecodeError as e:
+        raise GeminiResponseError(f"Error decoding JSON response from Gemini: {e}", response_text) from e
+    # Without a response schema the items may also come back as a bare list
+    sku_data = json_data.get("sku_data", []) if isinstance(json_data, dict) else json_data
+    return _validate_sku_data(sku_data, response_stream)
+
+def _validate_sku_data(sku_data, response_stream):
+    """Checks the extracted items against RawSkuItem and returns them as plain dictionaries."""
+    try:
+        return _RAW_SKU_ITEMS.dump_python(_RAW_SKU_ITEMS.validate_python(sku_data))
+    except ValidationError as e:
+        raise GeminiResponseError(
+            f"Gemini response does not match the expected SKU fields: {e}", "".join(response_stream.text_parts)
+        ) from e
+
+# Persisted to disk so results survive app restarts and are shared across sessions.
+# Streamlit ignores ttl for disk-persisted caches, so only max_entries bounds it.
+@st.cache_data(persist="disk", max_entries=32, show_spinner=False)
+def _extract_sku_data(file_hashes, _files, _file_cache):
+    """
+    Synchronous, cached entry point for the async extraction.
+    Cached on the files' content hashes; `_files` holds (name, mime_type, bytes) tuples and
+    `_file_cache` maps content hashes to uploaded Gemini files. Neither is hashed.
+    Raises on failure so that errors are never cached.
+    """
     client = genai.Client(
         api_key=os.environ.get("GEMINI_API_KEY"),
     )
+    return asyncio.run(_extract_sku_data_async(client, file_hashes, _files, _file_cache))
 
-    gemini_files = []
-    file_uris_for_prompt = []
-    temp_files = []
-    try:
-        with st.spinner(f"Uploading {len(uploaded_files)} files to Gemini..."):
-            for uploaded_file in uploaded_files:
-                # Save uploaded file to a temporary file
-                file_extension = os.path.splitext(uploaded_file.name)[1]
-                with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp:
-                    tmp.write(uploaded_file.getvalue())
-                    temp_files.append(tmp.name)
-                # Upload file using file path (latest Gemini API)
-                gf = client.files.upload(file=tmp.name)
-                gemini_files.append(gf)
-                file_uris_for_prompt.append(
-                    types.Part.from_uri(file_uri=gf.uri, mime_type=gf.mime_type)
-                )
-                st.write(f"Uploaded {uploaded_file.name} to Gemini.")
-
-        # Prepare prompt parts
-        prompt_parts = [
-            *file_uris_for_prompt,
-            types.Part.from_text(text="""These are PDF quotation files received by a company.
-                                  \nInstructions:\n
-                                  1. For each distinct product item listed in these documents, extract the following details.\n
-                                  2. The 'sku_supplier' should be the name of the company providing the quotation (e.g., NARSINGH PHARMA, MEDIVISION, S. D. M. AGENCY), not the medicine manufacturer like Alembic, Cipla, etc.\n
-                                  3. Extract the product name as 'sku_name' (e.g., PARACETAMOL 500MG TAB). \n
-                                  If there are product names across the quotations with similar product names, they should be given a common sku_name and used in the output\
-                                  Ex: (i) "GLUCONORM G 1" and "GLUCONORM G1" are the same product \n
-                                      (ii) "JANUMET 50/500" and "JANUMET 50/500 TAB" are the same product\n
-                                      (iii) "JUST TEAR E/D" and "JUST TEAR LUBRICANT E/D" are the same product\n
-                                      (iv) "SEROFLO 250 R/C", "SEROFLO 250 ROTA" and "SEROFLO 250 ROTACAP" are the same product\n
-                                      (v) "ATORVA 20MG TAB" and "ATORVA-20" are the same product\n
-                                  etc.\n
-                                  4. Ensure all numeric fields like MRP, Base Rate, and Discount are extracted as strings, exactly as they appear.\n
-                                  5. Extract the paid quantity as an integer in the 'paid_qty' field.\n
-                                  6. Extract the free quantity as an integer in the 'free_qty' field.\n
-                                  7. If a product appears in multiple documents, create a separate entry for each instance.\n
-                                  8. Extract the batch number for each item. This is typically labeled "Batch" and may look like "IAK0040", "24491211", or "JT-2412".\n
-                                  9. Extract the total price for the listed quantity of the SKU as an integer in the 'amount' field.\n
-                                  Extract the data in the specified JSON schema including 'sku_name', 'paid_qty', 'free_qty', and 'amount'."""),
-        ]
-
-        generate_content_config = types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=genai.types.Schema(
-                type=genai.types.Type.OBJECT,
-                properties={
-                    "sku_data": genai.types.Schema(
-                        type=genai.types.Type.ARRAY,
-                        items=genai.types.Schema(
-                            type=genai.types.Type.OBJECT,
-                            properties={
-                                "sku_supplier": genai.types.Schema(type=genai.types.Type.STRING),
-                                "sku_invoice": genai.types.Schema(type=genai.types.Type.STRING),
-                                "sku_name": genai.types.Schema(type=genai.types.Type.STRING),
-                                "mrp": genai.types.Schema(type=genai.types.Type.STRING),
-                                "base_rate": genai.types.Schema(type=genai.types.Type.STRING),
-                                "base_discount_percent": genai.types.Schema(type=genai.types.Type.STRING),
-                                "paid_qty": genai.types.Schema(type=genai.types.Type.INTEGER),
-                                "free_qty": genai.types.Schema(type=genai.types.Type.INTEGER),
-                                "batch_number": genai.types.Schema(type=genai.types.Type.STRING),
-                                "amount": genai.types.Schema(type=genai.types.Type.INTEGER),
-                            },
-                        ),
-                    ),
-                },
-            ),
+def _prepare_files(uploaded_files):
+    """Returns the content hashes and (name, mime_type, bytes) tuples of the uploaded files, without duplicates."""
+    # Identical PDFs (same content hash) are only sent to Gemini once
+    unique_files = {}
+    for uploaded_file in uploaded_files:
+        file_bytes = uploaded_file.getvalue()
+        unique_files.setdefault(
+            hashlib.sha256(file_bytes).hexdigest(), (uploaded_file.name, uploaded_file.type, file_bytes)
         )
+    if len(unique_files) < len(uploaded_files):
+        logging.info(f"Skipping {len(uploaded_files) - len(unique_files)} duplicate file(s).")
+    return tuple(unique_files), tuple(unique_files.values())
 
-        st.write("Sending request to Gemini for data extraction...")
-        with st.spinner("Gemini is processing the documents... This may take a moment."):
-            response_text = ""
-            for chunk in client.models.generate_content_stream(
-                model="gemini-2.0-flash",
-                contents=[types.Content(role="user", parts=prompt_parts)],
-                config=generate_content_config,
-            ):
-                response_text += chunk.text
-
-        # Try to parse the JSON output
-        try:
-            json_data = json.loads(response_text)
-            logging.info("Successfully decoded JSON response from Gemini.")
-            return json_data.get("sku_data", [])
-        except json.JSONDecodeError as e:
-            logging.error(f"Error decoding JSON response from Gemini: {e}")
-            st.error(f"Error decoding JSON response from Gemini. See logs for details.")
-            st.text_area("Gemini Raw Response (Decoding Error)", response_text, height=200)
-            return None
-        except Exception as e:
-            logging.error(f"An unexpected error occurred while processing Gemini response: {e}")
-            st.error(f"An unexpected error occurred while processing Gemini response. See logs for details.")
-            st.text_area("Gemini Raw Response (Processing Error)", response_text, height=200)
-            return None
-    except Exception as e:
+def _report_extraction_error(e):
+    """Shows an extraction failure in the UI. Must be called from the script thread."""
+    if isinstance(e, GeminiResponseError):
+        logging.error(str(e))
+        st.error("Error decoding JSON response from Gemini. See logs for details.")
+        st.text_area("Gemini Raw Response (Decoding Error)", e.response_text, height=200)
+    else:
         logging.error(f"An error occurred during Gemini processing: {e}")
         st.error(f"An error occurred during Gemini processing. See logs for details.")
-        return None
-    finally:
-        # Clean up temp files
-        for f in temp_files:
+
+def run_gemini_extraction_batches(batches, on_batch_done=None):
+    """
+    Extracts structured SKU data from several batches of uploaded files, with up to
+    MAX_CONCURRENT_BATCHES Gemini requests in flight at once.
+    `on_batch_done(batch_index)` is called on the script thread as each batch finishes, for progress updates.
+    Returns one result per batch, in order: a list of raw SKU dictionaries, or None on failure.
+    """
+    # Gemini file URIs by content hash, kept across reruns so re-uploads are avoided
+    file_cache = st.session_state.setdefault("_gemini_file_cache", {})
+    script_ctx = get_script_run_ctx()
+
+    def extract_batch(uploaded_files):
+        # Worker threads need the script context for the st.cache_data lookup
+        add_script_run_ctx(threading.current_thread(), script_ctx)
+        file_hashes, files = _prepare_files(uploaded_files)
+        return _extract_sku_data(file_hashes, files, file_cache)
+
+    results = [None] * len(batches)
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_BATCHES, len(batches)))) as executor:
+        futures = {
+            executor.submit(extract_batch, uploaded_files): batch_index
+            for batch_index, uploaded_files in enumerate(batches) if uploaded_files
+        }
+        for future in as_completed(futures):
+            batch_index = futures[future]
             try:
-                os.remove(f)
+                results[batch_index] = future.result()
             except Exception as e:
-                logging.warning(f"Could not remove temporary file {f}: {e}")
\ No newline at end of file
+                errors[batch_index] = e
+            if on_batch_done:
+                on_batch_done(batch_index)
+
+    # UI updates stay on the script thread, in batch order
+    for batch_index in sorted(errors):
+        _report_extraction_error(errors[batch_index])
+    return results
+
+def run_gemini_extraction(uploaded_files):
+    """
+    Extracts structured SKU data from the uploaded files with Gemini.
+    Results are cached by file content, so re-running on the same files skips the API calls.
+    Returns a list of dictionaries representing raw SKU data, or None on failure.
+    """
+    if not uploaded_files:
+        return None
+
+    with st.spinner(f"Gemini is processing {len(uploaded_files)} files... This may take a moment."):
+        return run_gemini_extraction_batches([uploaded_files])[0]
@@ -1,22 +1,24 @@
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import List, Optional, Union
+from pydantic import BaseModel, ConfigDict, Field
 
-@dataclass
+@dataclass(slots=True)
 class RawSkuItem:
     """Represents the raw data extracted directly from the Gemini API."""
     sku_supplier: Optional[str] = None
     sku_invoice: Optional[str] = None
     sku_name: Optional[str] = None
-    mrp: Optional[str] = None
-    base_rate: Optional[str] = None
-    base_discount_percent: Optional[str] = None
+    # Prices may arrive as JSON numbers or as text; numbers are kept as-is so they need no re-parsing
+    mrp: Optional[Union[float, str]] = None
+    base_rate: Optional[Union[float, str]] = None
+    base_discount_percent: Optional[Union[float, str]] = None
     qty_str: Optional[str] = None
     paid_qty: Optional[int] = None
     free_qty: Optional[int] = None
     batch_number: Optional[str] = None
-    amount: Optional[int] = None
+    amount: Optional[Union[int, float]] = None
 
-@dataclass
+@dataclass(slots=True)
 class ProcessedSkuItem:
     """Represents a processed SKU item with calculated metrics."""
     supplier: str
@@ -33,11 +35,10 @@ class ProcessedSkuItem:
     calculated_rate_per_qty: Optional[float] = None
     batch_number: str = "N/A"
 
-from pydantic import BaseModel, Field
-from typing import List
-
 class SkuNameMapping(BaseModel):
     """Represents a mapping from an original SKU name to its normalized form."""
+    model_config = ConfigDict(frozen=True)
+
     original_sku_name: str = Field(description="The original SKU name extracted from the document")
     normalized_sku_name: str = Field(description='''The canonical or deduplicated form of the SKU name  
                                   Ex: (i) "GLUCONORM G 1" and "GLUCONORM G1" are the same product \n
@@ -48,4 +49,6 @@ class SkuNameMapping(BaseModel):
 
 class BatchSkuNameNormalization(BaseModel):
     """Represents a batch of SKU name normalizations, mapping multiple original names to their canonical forms."""
+    model_config = ConfigDict(frozen=True)
+
     mappings: List[SkuNameMapping] = Field(description="List of SKU name normalizations")
@@ -1,17 +1,31 @@
 import pandas as pd
+import numpy as np
 import re
-from typing import List, Dict, Any, Optional
+from dataclasses import fields
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Iterable, Union
 from models import ProcessedSkuItem, SkuNameMapping, BatchSkuNameNormalization # Import the data model
 import instructor
+import diskcache
 import openai # openai is a dependency of instructor
 import logging
 
+# numexpr is optional; it only pays off on large batches
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+NUMEXPR_MIN_ROWS = 5000
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def calculate_item_metrics(base_rate: Optional[float], base_discount_percent: Optional[float], paid_qty: int, free_qty: int) -> tuple[Optional[float], Optional[float], Optional[float]]:
-    """Calculates effective rate, effective discount, and comparison rate."""
-    if base_rate is None or base_rate < 0 or paid_qty is None or free_qty is None:
+    """
+    Calculates effective rate, effective discount, and comparison rate.
+    Values are returned unrounded; rounding to 2 decimals happens at display time.
+    """
+    if base_rate is None or paid_qty is None or free_qty is None or base_rate < 0:
         return None, None, None
     
     base_discount_percent = base_discount_percent if base_discount_percent is not None else 0.0
@@ -25,197 +39,272 @@ def calculate_item_metrics(base_rate: Optional[float], base_discount_percent: Op
         total_cost_for_paid_items = paid_qty * eff_rate_display
         comparison_rate = total_cost_for_paid_items / (paid_qty + free_qty)
     
-    return round(eff_rate_display, 2), round(eff_disc_display, 2), round(comparison_rate, 2)
+    return eff_rate_display, eff_disc_display, comparison_rate
 
-def preprocess_data(raw_data_list: List[Dict[str, Any]]) -> List[ProcessedSkuItem]:
-    """
-    Processes raw data extracted from Gemini into a list of ProcessedSkuItem objects.
-    Handles data conversion and basic validation.
-    """
-    processed_items = []
-    if not raw_data_list:
-        return []
-        
-    for item in raw_data_list:
-        # Use .get() with default values for robustness
-        sku_name = item.get("sku_name", "UNKNOWN_SKU_NAME").strip()
-        sku_as_extracted = item.get("sku_invoice", "UNKNOWN_SKU").strip()
-
-        # Get paid_qty and free_qty directly from raw data, with error handling and logging
-        paid_qty = item.get("paid_qty")
-        free_qty = item.get("free_qty")
-
-        if paid_qty is None or free_qty is None:
-             logging.warning(f"Missing paid_qty or free_qty for SKU '{sku_name}' from supplier '{item.get('sku_supplier', 'N/A')}'. Skipping item.")
-             continue
-
-        try:
-            paid_qty = int(paid_qty)
-            free_qty = int(free_qty)
-        except (ValueError, TypeError) as e:
-            logging.warning(f"Invalid paid_qty or free_qty (not integers) for SKU '{sku_name}' from supplier '{item.get('sku_supplier', 'N/A')}': {e}. Skipping item.")
-            continue
-
-        try:
-            # Convert string inputs from Gemini to float, handle missing discount
-            mrp_str = item.get("mrp")
-            base_rate_str = item.get("base_rate")
-            discount_str = item.get("base_discount_percent", "0").strip() # Default to "0" if missing
-
-            mrp = float(mrp_str) if mrp_str else 0.0
-            base_rate = float(base_rate_str) if base_rate_str else 0.0
-            base_discount_percent = float(discount_str) if discount_str else 0.0
-
-        except (ValueError, TypeError) as e:
-            logging.warning(f"Data conversion error for SKU '{sku_name}' from supplier '{item.get('sku_supplier', 'N/A')}': {e}. Skipping item.")
-            continue
-
-        if paid_qty == 0 and free_qty == 0:
-            logging.info(f"Skipping item for SKU '{sku_name}' from supplier '{item.get('sku_supplier', 'N/A')}' as both paid_qty and free_qty are zero.")
-            continue
-
-        # Get amount and calculate calculated_rate_per_qty
-        amount = item.get("amount")
-        calculated_rate_per_qty = None
-        total_qty = paid_qty + free_qty
-
-        if amount is not None and total_qty > 0:
-            try:
-                calculated_rate_per_qty = float(amount) / total_qty
-            except (ValueError, TypeError) as e:
-                logging.warning(f"Invalid amount or quantity for rate calculation for SKU '{sku_name}' from supplier '{item.get('sku_supplier', 'N/A')}': {e}")
-                calculated_rate_per_qty = None # Ensure it's None on error
-
-        # Calculate existing metrics (Eff. Rate, Eff. Disc, Comparison Eff. Rate)
-        eff_rate_disp, eff_disc_disp, comparison_rate = calculate_item_metrics(
-            base_rate, base_discount_percent, paid_qty, free_qty
-        )
+# Columns of the processed items DataFrame, one per ProcessedSkuItem field
+PROCESSED_ITEM_COLUMNS = [f.name for f in fields(ProcessedSkuItem)]
 
-        processed_items.append(ProcessedSkuItem(
-            supplier=item.get("sku_supplier", "UNKNOWN_SUPPLIER").strip(),
-            sku=sku_as_extracted, # Invoice code
-            sku_name=sku_name,    # Human readable name
-            mrp=mrp,
-            base_rate=base_rate,
-            paid_qty=paid_qty,
-            free_qty=free_qty,
-            qty_display_str=f"{paid_qty}+{free_qty}", # Keep display string format
-            eff_rate_display_column=eff_rate_disp,
-            eff_disc_display_column=eff_disc_disp,
-            comparison_eff_rate=comparison_rate, # Keep for now, will remove later
-            calculated_rate_per_qty=calculated_rate_per_qty, # Add the new calculated rate
-            batch_number=item.get("batch_number", "N/A").strip(), # Include batch number
-        ))
-    logging.info(f"Successfully processed {len(processed_items)} SKU items.")
-    return processed_items
-
-def get_supplier_unique_sku_counts(all_processed_items: List[ProcessedSkuItem]) -> Dict[str, int]:
-    """Calculates the number of unique SKUs per supplier based on raw SKU code."""
-    supplier_skus = {}
-    for item in all_processed_items:
-        supplier = item.supplier
-        sku = item.sku # Using raw SKU
-        if supplier not in supplier_skus:
-            supplier_skus[supplier] = set()
-        supplier_skus[supplier].add(sku)
-    return {supplier: len(skus) for supplier, skus in supplier_skus.items()}
-
-def generate_comparison_table(target_sku_names: List[str], all_processed_items: List[ProcessedSkuItem], display_suppliers_order: List[str]) -> pd.DataFrame:
-    """Generates a pandas DataFrame for the SKU comparison table."""
-    output_data_rows = []
-    supplier_unique_counts = get_supplier_unique_sku_counts(all_processed_items)
-
-    for sku_name in target_sku_names: # sku_name is now the normalized name
-        row_dict = {('SKU Name', ''): sku_name}
-        offers_for_this_sku = []
-        original_sku_codes_for_this_normalized_name = set() # Use a set to store unique original codes
-
-        for item in all_processed_items:
-            if item.sku_name == sku_name: # item.sku_name is already normalized
-                offers_for_this_sku.append(item)
-                if item.sku: # Ensure item.sku is not None or empty before adding
-                    original_sku_codes_for_this_normalized_name.add(item.sku) # item.sku is the original invoice code
-                if item.supplier in display_suppliers_order:
-                    supplier_name = item.supplier
-                    row_dict[(supplier_name, "MRP")] = f"{item.mrp:.2f}" if item.mrp is not None else "-"
-                    row_dict[(supplier_name, "Base Rate")] = f"{item.base_rate:.2f}" if item.base_rate is not None else "-"
-                    row_dict[(supplier_name, "Eff. Rate")] = f"{item.eff_rate_display_column:.2f}" if item.eff_rate_display_column is not None else "-"
-                    row_dict[(supplier_name, "Eff. Disc% ")] = f"{item.eff_disc_display_column:.2f} %" if item.eff_disc_display_column is not None else "-" # Format with %
-                    row_dict[(supplier_name, "Qty")] = item.qty_display_str
-                    row_dict[(supplier_name, "SKU Code")] = item.sku
-                    row_dict[(supplier_name, "Batch Number")] = item.batch_number # Add Batch Number
-                    row_dict[(supplier_name, "Calc. Rate/Qty")] = f"{item.calculated_rate_per_qty:.2f}" if item.calculated_rate_per_qty is not None else "-" # Add Calculated Rate/Qty
-        for s_name in display_suppliers_order:
-            if (s_name, "MRP") not in row_dict:
-                for col_name in ["MRP", "Base Rate", "Eff. Rate", "Eff. Disc% ", "Qty", "SKU Code", "Batch Number", "Calc. Rate/Qty"]: # Add Calculated Rate/Qty here too
-                    row_dict[(s_name, col_name)] = "-"
-
-        best_deal_text = "-"
-        if offers_for_this_sku:
-            # Sort by calculated_rate_per_qty (ascending), then paid_qty (ascending), then supplier unique count (desc)
-            # Treat None calculated_rate_per_qty as the worst (highest value)
-            offers_for_this_sku.sort(key=lambda x: (
-                x.calculated_rate_per_qty if x.calculated_rate_per_qty is not None else float('inf'),
-                x.paid_qty,
-                -supplier_unique_counts.get(x.supplier, 0)
-            ))
-            # Check if the best offer has a valid calculated_rate_per_qty
-            if offers_for_this_sku[0].calculated_rate_per_qty is not None:
-                best_offer = offers_for_this_sku[0]
-                best_deal_text = f"{best_offer.supplier}" # Update Best Deal text to only show supplier
-        
-        # After processing all items for this sku_name:
-        row_dict[('Original SKUs', '')] = ", ".join(sorted(list(original_sku_codes_for_this_normalized_name)))
+# Columns expected in each raw item dict returned by Gemini
+RAW_ITEM_COLUMNS = [
+    "sku_supplier", "sku_invoice", "sku_name", "mrp", "base_rate",
+    "base_discount_percent", "paid_qty", "free_qty", "batch_number", "amount",
+]
 
-        row_dict[('Best Deal', '')] = best_deal_text
-        output_data_rows.append(row_dict)
+def _strip_column(values: pd.Series, default: str) -> pd.Series:
+    """Fills missing values with a default and strips surrounding whitespace."""
+    return values.fillna(default).astype(str).str.strip()
 
-    if not output_data_rows:
-        return pd.DataFrame()
+def _to_float_column(values: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """
+    Converts a column of numeric strings to floats. Missing or blank values become 0.0.
+    Returns the converted column and a mask of values that could not be converted.
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        # Already numbers (e.g. Gemini returned floats): nothing to strip or parse
+        return values.fillna(0.0).astype(float), pd.Series(False, index=values.index)
 
-    df = pd.DataFrame(output_data_rows)
+    text = values.astype("string").str.strip()
+    blank = text.isna() | (text == "")
+    numbers = pd.to_numeric(text.mask(blank), errors="coerce")
+    invalid = numbers.isna() & ~blank
+    return numbers.fillna(0.0).astype(float), invalid
 
-    column_tuples = [('SKU Name', '')]
-    for supplier_name in display_suppliers_order:
-        column_tuples.extend([
-            (supplier_name, "MRP"), (supplier_name, "Base Rate"),
-            (supplier_name, "Eff. Rate"), (supplier_name, "Eff. Disc% "),
-            (supplier_name, "Qty"), (supplier_name, "SKU Code"), (supplier_name, "Batch Number"), 
-            (supplier_name, "Calc. Rate/Qty") 
-        ])
-    column_tuples.append(('Original SKUs', '')) # Add the new column header
-    column_tuples.append(('Best Deal', ''))
+def calculate_item_metrics_vectorized(base_rate: np.ndarray, base_discount_percent: np.ndarray, paid_qty: np.ndarray, free_qty: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Array version of calculate_item_metrics. Rows with a negative base rate get NaN metrics.
+    Like the scalar version, values are left unrounded for display-time formatting.
+    """
+    if numexpr is not None and len(base_rate) >= NUMEXPR_MIN_ROWS:
+        # Large batches: one fused pass per output instead of several NumPy temporaries
+        local_dict = {
+            "base_rate": base_rate, "disc": base_discount_percent.astype(float),
+            "paid": paid_qty, "free": free_qty, "inf": np.inf, "nan": np.nan,
+        }
+        eff_rate_display = numexpr.evaluate("where(base_rate < 0, nan, base_rate * (1 - disc / 100.0))", local_dict=local_dict)
+        eff_disc_display = numexpr.evaluate("where(base_rate < 0, nan, disc)", local_dict=local_dict)
+        comparison_rate = numexpr.evaluate(
+            "where(base_rate < 0, nan, where(paid + free != 0,"
+            " paid * (base_rate * (1 - disc / 100.0)) / (paid + free), where(paid > 0, inf, 0.0)))",
+            local_dict=local_dict,
+        )
+        return eff_rate_display, eff_disc_display, comparison_rate
 
-    final_cols_index = pd.MultiIndex.from_tuples(column_tuples)
-    df = df.reindex(columns=final_cols_index, fill_value="-")
+    # Fresh arrays, so the invalid rows can be blanked in place below
+    eff_rate_display = base_rate * (1 - base_discount_percent / 100.0)
+    eff_disc_display = base_discount_percent.astype(float)
 
-    if not df.empty:
-        df = df.set_index(('SKU Name', ''))
-        df.index.name = "SKU Name"
+    # Divide only where there is a quantity, straight into the output; zero-quantity rows stay 0.0
+    # unless something is paid for, in which case they are inf
+    total_qty = paid_qty + free_qty
+    has_qty = total_qty != 0
+    comparison_rate = np.zeros(len(base_rate))
+    np.divide(paid_qty * eff_rate_display, total_qty, out=comparison_rate, where=has_qty)
+    comparison_rate[~has_qty & (paid_qty > 0)] = np.inf
 
-    return df
+    invalid = base_rate < 0
+    eff_rate_display[invalid] = np.nan
+    eff_disc_display[invalid] = np.nan
+    comparison_rate[invalid] = np.nan
 
-def normalize_sku_names(sku_names: List[str], client: instructor.Instructor) -> Dict[str, str]:
-    """
-    Normalizes a list of SKU names using an LLM call via the instructor library.
+    return eff_rate_display, eff_disc_display, comparison_rate
 
-    Args:
-        sku_names: A list of original SKU names.
-        client: An initialized instructor client (e.g., from OpenAI, Gemini, or another provider).
-                The client should be pre-configured with the desired model.
+def preprocess_data(raw_data_list: Union[pd.DataFrame, Iterable[Dict[str, Any]]]) -> pd.DataFrame:
+    """
+    Processes raw data extracted from Gemini into a DataFrame with one row per processed item.
+    Columns follow the ProcessedSkuItem fields; missing metrics are NaN.
+    Accepts a DataFrame of raw items or any iterable of raw item dicts, so items can be consumed as they are parsed.
+    Handles data conversion and basic validation column-wise with pandas.
+    """
+    if raw_data_list is None:
+        return pd.DataFrame(columns=PROCESSED_ITEM_COLUMNS)
 
-    Returns:
-        A dictionary mapping original SKU names to their normalized forms.
-        Returns a dictionary mapping original names to themselves if normalization fails or sku_names is empty.
+    if isinstance(raw_data_list, pd.DataFrame):
+        df = raw_data_list.reindex(columns=RAW_ITEM_COLUMNS)
+    else:
+        df = pd.DataFrame(list(raw_data_list), columns=RAW_ITEM_COLUMNS)
+    if df.empty:
+        return pd.DataFrame(columns=PROCESSED_ITEM_COLUMNS)
+
+    sku_name = _strip_column(df["sku_name"], "UNKNOWN_SKU_NAME")
+    supplier = _strip_column(df["sku_supplier"], "UNKNOWN_SUPPLIER")
+
+    # Get paid_qty and free_qty directly from raw data, skipping rows that are missing or not integers
+    missing_qty = df["paid_qty"].isna() | df["free_qty"].isna()
+    paid_qty = pd.to_numeric(df["paid_qty"], errors="coerce")
+    free_qty = pd.to_numeric(df["free_qty"], errors="coerce")
+    invalid_qty = ~missing_qty & (paid_qty.isna() | free_qty.isna())
+
+    # Convert string inputs from Gemini to float, treating missing values as 0.0
+    mrp, invalid_mrp = _to_float_column(df["mrp"])
+    base_rate, invalid_base_rate = _to_float_column(df["base_rate"])
+    base_discount_percent, invalid_discount = _to_float_column(df["base_discount_percent"])
+    conversion_error = ~missing_qty & ~invalid_qty & (invalid_mrp | invalid_base_rate | invalid_discount)
+
+    zero_qty = ~missing_qty & ~invalid_qty & ~conversion_error & (paid_qty == 0) & (free_qty == 0)
+
+    for idx in df.index[missing_qty]:
+        logging.warning("Missing paid_qty or free_qty for SKU '%s' from supplier '%s'. Skipping item.", sku_name[idx], supplier[idx])
+    for idx in df.index[invalid_qty]:
+        logging.warning("Invalid paid_qty or free_qty (not integers) for SKU '%s' from supplier '%s'. Skipping item.", sku_name[idx], supplier[idx])
+    for idx in df.index[conversion_error]:
+        logging.warning("Data conversion error for SKU '%s' from supplier '%s'. Skipping item.", sku_name[idx], supplier[idx])
+    for idx in df.index[zero_qty]:
+        logging.info("Skipping item for SKU '%s' from supplier '%s' as both paid_qty and free_qty are zero.", sku_name[idx], supplier[idx])
+
+    keep = ~(missing_qty | invalid_qty | conversion_error | zero_qty)
+    paid = paid_qty[keep].astype(int).to_numpy()
+    free = free_qty[keep].astype(int).to_numpy()
+    base_rate_kept = base_rate[keep].to_numpy()
+    total_qty = paid + free
+
+    # Calculated rate per qty from the total amount, left empty when the amount is missing or invalid
+    amount = pd.to_numeric(df["amount"][keep], errors="coerce").to_numpy(dtype=float)
+    invalid_amount = df["amount"][keep].notna().to_numpy() & np.isnan(amount)
+    for idx in df.index[keep][invalid_amount]:
+        logging.warning("Invalid amount or quantity for rate calculation for SKU '%s' from supplier '%s'", sku_name[idx], supplier[idx])
+    calculated_rate_per_qty = np.full(len(amount), np.nan)
+    np.divide(amount, total_qty, out=calculated_rate_per_qty, where=total_qty > 0)
+
+    # Calculate existing metrics (Eff. Rate, Eff. Disc, Comparison Eff. Rate)
+    eff_rate_disp, eff_disc_disp, comparison_rate = calculate_item_metrics_vectorized(
+        base_rate_kept, base_discount_percent[keep].to_numpy(), paid, free
+    )
+
+    # supplier, sku_name and batch_number repeat across many rows, so they are stored as categoricals
+    processed = pd.DataFrame({
+        "supplier": supplier[keep].astype("category"),
+        "sku": _strip_column(df["sku_invoice"][keep], "UNKNOWN_SKU"), # Invoice code
+        "sku_name": sku_name[keep].astype("category"), # Human readable name
+        "mrp": mrp[keep],
+        "base_rate": base_rate_kept,
+        "paid_qty": paid,
+        "free_qty": free,
+        "qty_display_str": np.char.add(np.char.add(paid.astype(str), "+"), free.astype(str)),
+        "eff_rate_display_column": eff_rate_disp,
+        "eff_disc_display_column": eff_disc_disp,
+        "comparison_eff_rate": comparison_rate,
+        "calculated_rate_per_qty": calculated_rate_per_qty,
+        "batch_number": _strip_column(df["batch_number"][keep], "N/A").astype("category"),
+    }).reset_index(drop=True)
+
+    logging.info(f"Successfully processed {len(processed)} SKU items.")
+    return processed
+
+def get_supplier_unique_sku_counts(processed_df: pd.DataFrame) -> Dict[str, int]:
+    """Calculates the number of unique SKUs per supplier based on raw SKU code."""
+    # One grouped distinct count; sku is never missing after preprocessing
+    return processed_df.groupby("supplier", sort=False, observed=True)["sku"].nunique().to_dict()
+
+# Per-supplier comparison columns, in display order, and the processed item column each one shows
+METRIC_COLUMN_FIELDS = {
+    "MRP": "mrp",
+    "Base Rate": "base_rate",
+    "Eff. Rate": "eff_rate_display_column",
+    "Eff. Disc% ": "eff_disc_display_column",
+    "Qty": "qty_display_str",
+    "SKU Code": "sku",
+    "Batch Number": "batch_number",
+    "Calc. Rate/Qty": "calculated_rate_per_qty",
+}
+# Per-supplier comparison columns holding numbers (missing values are NaN)
+NUMERIC_METRIC_COLUMNS = ["MRP", "Base Rate", "Eff. Rate", "Eff. Disc% ", "Calc. Rate/Qty"]
+
+def generate_comparison_table(
+    target_sku_names: List[str],
+    processed_df: pd.DataFrame,
+    display_suppliers_order: List[str],
+    supplier_unique_counts: Optional[Dict[str, int]] = None,
+) -> pd.DataFrame:
     """
-    if not sku_names:
-        logging.info("normalize_sku_names: Received empty list of SKU names.")
-        return {}
+    Generates a pandas DataFrame for the SKU comparison table.
+    One row per target SKU name; each supplier gets the METRIC_COLUMN_FIELDS columns, followed by
+    'Original SKUs' and 'Best Deal'. Cells without an offer are NaN for numbers and "-" otherwise.
+    supplier_unique_counts (from get_supplier_unique_sku_counts) is recomputed when not given.
+    """
+    if not target_sku_names:
+        return pd.DataFrame()
 
-    # Process unique SKU names to avoid redundant calls and simplify LLM's task
-    unique_sku_names = sorted(list(set(sku_names)))
-    
-    prompt = f"""
+    if supplier_unique_counts is None:
+        supplier_unique_counts = get_supplier_unique_sku_counts(processed_df)
+    # Precompute the supplier tie-break rank once (more unique SKUs sorts first)
+    supplier_rank = {supplier: -count for supplier, count in supplier_unique_counts.items()}
+
+    # All offers for the target SKUs (sku_name is already normalized)
+    offers = processed_df[processed_df["sku_name"].isin(set(target_sku_names))]
+
+    # Pivot the displayed suppliers' offers into (supplier, metric) columns with one groupby/unstack.
+    # If a supplier quotes the same SKU more than once, its last offer is shown.
+    displayed = offers[offers["supplier"].isin(set(display_suppliers_order))].drop_duplicates(
+        ["sku_name", "supplier"], keep="last"
+    )
+    metric_columns = pd.MultiIndex.from_product([display_suppliers_order, list(METRIC_COLUMN_FIELDS)])
+    table = (
+        displayed.set_index(["sku_name", "supplier"])[list(METRIC_COLUMN_FIELDS.values())]
+        .set_axis(list(METRIC_COLUMN_FIELDS), axis=1)
+        .unstack("supplier")
+        .swaplevel(axis=1)
+        .reindex(index=target_sku_names, columns=metric_columns)
+    )
+    numeric_columns = [col for col in metric_columns if col[1] in NUMERIC_METRIC_COLUMNS]
+    text_columns = [col for col in metric_columns if col[1] not in NUMERIC_METRIC_COLUMNS]
+    table[numeric_columns] = table[numeric_columns].astype(float)
+    # Categorical columns (batch number) can't take "-" as a fill value, so decode them first
+    table[text_columns] = table[text_columns].astype(object).fillna("-").astype(str)
+
+    # Sorted, unique original invoice codes per SKU name
+    sku_codes = offers.loc[offers["sku"] != "", ["sku_name", "sku"]].drop_duplicates().sort_values("sku")
+    original_skus = sku_codes.groupby("sku_name", sort=False, observed=True)["sku"].agg(", ".join)
+    table[("Original SKUs", "")] = original_skus.reindex(target_sku_names).fillna("").to_numpy(dtype=object)
+
+    # Pick every SKU's best deal with one sort instead of a Python sort per SKU:
+    # calculated_rate_per_qty (ascending), then paid_qty (ascending), then supplier unique count (desc).
+    # Offers without a calculated_rate_per_qty never win, so a SKU with none of them shows "-".
+    best_deals = (
+        offers[["sku_name", "supplier", "calculated_rate_per_qty", "paid_qty"]]
+        .dropna(subset=["calculated_rate_per_qty"])
+        .assign(supplier_rank=lambda df: df["supplier"].map(supplier_rank).astype(float)) # map keeps the categorical dtype
+        .sort_values(["calculated_rate_per_qty", "paid_qty", "supplier_rank"], kind="stable")
+        .drop_duplicates("sku_name", keep="first")
+    )
+    table[("Best Deal", "")] = (
+        best_deals.set_index("sku_name")["supplier"].reindex(target_sku_names).astype(object).fillna("-").to_numpy()
+    )
+
+    table.index.name = "SKU Name"
+    return table
+
+# Normalized names persisted on disk per (model, prompt version, name key), so repeated runs skip the LLM
+# for known names. Bump NORMALIZATION_PROMPT_VERSION when the prompt changes to invalidate old entries.
+NORMALIZATION_MODEL = "qwen/qwen3-235b-a22b-07-25"
+NORMALIZATION_PROMPT_VERSION = 1
+NORMALIZATION_CACHE_EXPIRE = 30 * 24 * 60 * 60 # 30 days, in seconds
+_normalization_cache = diskcache.Cache(".sku_norm_cache")
+
+# Deterministic clean-up applied before the LLM, so trivially different spellings are normalized once
+_UNIT_RE = re.compile(r"(\d+)\s*(MG|ML|MCG|G)\b")
+_SKU_ABBREVIATIONS = {"TAB": "TABLET", "CAP": "CAPSULE", "SYP": "SYRUP", "INJ": "INJECTION", "AMP": "AMPOULE"}
+
+def _canonical_sku_name(sku_name: str) -> str:
+    """
+    Uppercases a SKU name, collapses whitespace, joins numbers to their units ("40 MG" -> "40MG"),
+    expands common dosage-form abbreviations and strips trailing punctuation.
+    """
+    canonical_name = " ".join(sku_name.upper().split()).rstrip(".,;:-")
+    canonical_name = _UNIT_RE.sub(r"\1\2", canonical_name)
+    return " ".join(_SKU_ABBREVIATIONS.get(token, token) for token in canonical_name.split())
+
+def _normalization_cache_key(sku_name: str) -> tuple:
+    """Cache key for a SKU name; names with the same canonical form share one entry."""
+    return (NORMALIZATION_MODEL, NORMALIZATION_PROMPT_VERSION, _canonical_sku_name(sku_name))
+
+# Names sent to the LLM per normalization request, and how many requests run at once.
+# Names are sorted before chunking so close variants usually land in the same chunk.
+NORMALIZATION_CHUNK_SIZE = 50
+MAX_CONCURRENT_NORMALIZATIONS = 4
+
+def _build_normalization_prompt(unique_sku_names: List[str]) -> str:
+    """Builds the normalization prompt for one chunk of unique SKU names."""
+    return f"""
     You are an expert in pharmaceutical and FMCG product catalog management.
     Your task is to normalize a list of SKU names. This means identifying SKUs
     that refer to the same product despite minor variations in naming, dosage,
@@ -269,27 +358,90 @@ def normalize_sku_names(sku_names: List[str], client: instructor.Instructor) ->
     {unique_sku_names}
     """
 
+def _normalize_chunk(chunk: List[str], client: instructor.Instructor) -> Dict[str, str]:
+    """
+    Sends one chunk of unique SKU names to the LLM and returns the valid mappings it produced.
+    A failed chunk returns an empty map so the other chunks are still used.
+    """
     try:
-        logging.info(f"normalize_sku_names: Sending {len(unique_sku_names)} unique SKU names for normalization (original list had {len(sku_names)} items).")
-        
         response: BatchSkuNameNormalization = client.chat.completions.create(
-            model = "qwen/qwen3-235b-a22b-07-25",
-            messages=[{"role": "user", "content": prompt}],
+            model = NORMALIZATION_MODEL,
+            messages=[{"role": "user", "content": _build_normalization_prompt(chunk)}],
             response_model=BatchSkuNameNormalization,
             # The 'model' parameter is typically set during client initialization or if the client is multi-model.
             # e.g., model="gemini-1.5-flash-latest" or specific OpenAI/Qwen model name.
         )
+    except Exception as e:
+        logging.error(f"normalize_sku_names: Error normalizing a chunk of {len(chunk)} SKU names: {e}", exc_info=True)
+        return {}
+
+    chunk_names = set(chunk)
+    chunk_map = {}
+    if response and response.mappings:
+        for mapping in response.mappings:
+            # Ensure the original name from the mapping is one we sent
+            if mapping.original_sku_name in chunk_names:
+                chunk_map[mapping.original_sku_name] = mapping.normalized_sku_name
+    else:
+        logging.warning("normalize_sku_names: Normalization API call returned no mappings or an empty/invalid response.")
+    return chunk_map
 
-        # Process the response, which contains mappings for unique_sku_names
+def normalize_sku_names(sku_names: List[str], client: instructor.Instructor) -> Dict[str, str]:
+    """
+    Normalizes a list of SKU names using LLM calls via the instructor library.
+    Names normalized in earlier runs are served from the on-disk cache; the rest are sent in chunks of
+    NORMALIZATION_CHUNK_SIZE, with up to MAX_CONCURRENT_NORMALIZATIONS requests in flight.
+
+    Args:
+        sku_names: A list of original SKU names.
+        client: An initialized instructor client (e.g., from OpenAI, Gemini, or another provider).
+                The client should be pre-configured with the desired model.
+
+    Returns:
+        A dictionary mapping original SKU names to their normalized forms.
+        Returns a dictionary mapping original names to themselves if normalization fails or sku_names is empty.
+    """
+    if not sku_names:
+        logging.info("normalize_sku_names: Received empty list of SKU names.")
+        return {}
+
+    # Process unique SKU names to avoid redundant calls and simplify LLM's task
+    unique_sku_names = sorted(list(set(sku_names)))
+
+    try:
+        # Names normalized in an earlier run come from the disk cache; only the rest go to the LLM,
+        # one representative per cache key (names with the same canonical form are sent once)
         temp_normalized_map = {}
-        if response and response.mappings:
-            for mapping in response.mappings:
-                # Ensure the original name from the mapping is one we sent
-                if mapping.original_sku_name in unique_sku_names:
-                    temp_normalized_map[mapping.original_sku_name] = mapping.normalized_sku_name
-            logging.info(f"normalize_sku_names: Received {len(temp_normalized_map)} valid mappings from LLM for {len(unique_sku_names)} unique SKUs.")
-        else:
-            logging.warning("normalize_sku_names: Normalization API call returned no mappings or an empty/invalid response.")
+        unknown_names_by_key = {}
+        for name in unique_sku_names:
+            cache_key = _normalization_cache_key(name)
+            cached_name = _normalization_cache.get(cache_key)
+            if cached_name is not None:
+                temp_normalized_map[name] = cached_name
+            else:
+                unknown_names_by_key.setdefault(cache_key, []).append(name)
+        unknown_sku_names = [names[0] for names in unknown_names_by_key.values()]
+        chunks = [
+            unknown_sku_names[i : i + NORMALIZATION_CHUNK_SIZE]
+            for i in range(0, len(unknown_sku_names), NORMALIZATION_CHUNK_SIZE)
+        ]
+        logging.info(f"normalize_sku_names: {len(temp_normalized_map)} of {len(unique_sku_names)} unique SKU names found in cache; sending {len(unknown_sku_names)} for normalization in {len(chunks)} chunk(s) (original list had {len(sku_names)} items).")
+
+        if chunks:
+            # Requests are network-bound, so a thread pool runs them concurrently
+            llm_normalized_map = {}
+            with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_NORMALIZATIONS, len(chunks))) as executor:
+                for chunk_map in executor.map(lambda chunk: _normalize_chunk(chunk, client), chunks):
+                    llm_normalized_map.update(chunk_map)
+            logging.info(f"normalize_sku_names: Received {len(llm_normalized_map)} valid mappings from LLM for {len(unknown_sku_names)} unique SKUs.")
+
+            # Only names the LLM actually mapped are cached, so failed chunks are retried next time.
+            # Every variant sharing the representative's cache key gets its normalized name.
+            for name, normalized_name in llm_normalized_map.items():
+                cache_key = _normalization_cache_key(name)
+                _normalization_cache.set(cache_key, normalized_name, expire=NORMALIZATION_CACHE_EXPIRE)
+                for variant_name in unknown_names_by_key[cache_key]:
+                    temp_normalized_map[variant_name] = normalized_name
 
         # Create the final map that maps all original SKU names (including duplicates)
         # to their normalized form. If a unique SKU wasn't in the LLM response,
@@ -307,4 +459,4 @@ def normalize_sku_names(sku_names: List[str], client: instructor.Instructor) ->
     except Exception as e:
         logging.error(f"normalize_sku_names: Error during SKU name normalization: {e}", exc_info=True)
         # In case of any error, return a dict mapping all original names to themselves
-        return {name: name for name in sku_names}
\ No newline at end of file
+        return {name: name for name in sku_names}
@@ -12,42 +12,42 @@ from streamlit.runtime.uploaded_file_manager import UploadedFile # Correct impor
 logging.debug("--- ui_components.py execution started ---")
 logging.debug(f"Python executable in ui_components: {sys.executable}")
 logging.debug(f"Streamlit version in ui_components: {st.__version__}")
-logging.debug(f"Type of st object in ui_components: {type(st)}")
-logging.debug(f"Attributes in st (ui_components): {dir(st)}")
+
+def supplier_column_indices(columns: pd.Index) -> Dict[str, List[int]]:
+    """Maps each supplier to the positions of its (supplier, metric) columns in the comparison table."""
+    column_indices: Dict[str, List[int]] = {}
+    for i, col_tuple in enumerate(columns):
+        if isinstance(col_tuple, tuple):
+            column_indices.setdefault(col_tuple[0], []).append(i)
+    return column_indices
 
 # Function to apply styling (can be here or in sku_processing, keeping here for UI context)
-def highlight_best_deal(row):
-    """Applies styling to highlight the best deal row."""
-    logging.debug(f"highlight_best_deal: Processing row with index {row.name}")
-    logging.debug(f"highlight_best_deal: Row data: {row.to_dict()}")
-    logging.debug(f"Row index (columns): {list(row.index)}")
+def highlight_best_deal(row, supplier_columns: Dict[str, List[int]]):
+    """
+    Applies styling to highlight the best deal row.
+    supplier_columns comes from supplier_column_indices, built once per table rather than per row.
+    """
+    # Called once per table row; %-style args and the level check keep disabled debug logging free
+    debug_enabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        logging.debug("highlight_best_deal: Processing row with index %s", row.name)
+        logging.debug("highlight_best_deal: Row data: %s", row.to_dict())
 
     # Assuming 'Best Deal' is the column indicating the best offer supplier name
     # The column name is a tuple ('Best Deal', '')
     styles = [''] * len(row)
     best_deal_supplier = row.get(('Best Deal', ''), "-") # Use .get() for safety
 
-    logging.debug(f"highlight_best_deal: Best deal supplier: {best_deal_supplier}")
+    if debug_enabled:
+        logging.debug("highlight_best_deal: Best deal supplier: %s", best_deal_supplier)
 
     if best_deal_supplier != "-":
-        try:
-            # Find the indices of all columns belonging to the best deal supplier
-            supplier_col_indices = [
-                i for i, col_tuple in enumerate(row.index)
-                if isinstance(col_tuple, tuple) and col_tuple[0] == best_deal_supplier
-            ]
-            logging.debug(f"highlight_best_deal: Supplier column indices for {best_deal_supplier}: {supplier_col_indices}")
-
-            # Apply green background to all cells in those columns for the current row
-            for i in supplier_col_indices:
-                styles[i] = 'background-color: #e0ffe0' # Light green
-                logging.debug(f"highlight_best_deal: Applied style to column index {i}")
-
-        except Exception as e:
-            # Log or handle potential errors in identifying columns
-            logging.error(f"highlight_best_deal: Error applying styling: {e}")
-
-    logging.debug(f"highlight_best_deal: Generated styles: {styles}")
+        # Apply green background to all cells in the best deal supplier's columns for the current row
+        for i in supplier_columns.get(best_deal_supplier, ()):
+            styles[i] = 'background-color: #e0ffe0' # Light green
+
+    if debug_enabled:
+        logging.debug("highlight_best_deal: Generated styles: %s", styles)
     return styles
 
 def render_file_uploader(uploaded_files: Optional[List[UploadedFile]], extract_handler: Callable[[List[UploadedFile]], None]):
@@ -91,28 +91,40 @@ def render_sku_selector(all_skus: List[str], selected_skus: List[str], select_ha
 
 
 def render_comparison_button(compare_handler: Callable[[], None]):
-     """Renders the Generate Comparison Table button."""
-     if st.button("2. Generate Comparison Table", key="compare_button"):
+     """Renders the Generate Comparison Table button as the submit button of the SKU selection form."""
+     if st.form_submit_button("2. Generate Comparison Table"):
          compare_handler()
 
 
+@st.cache_data(max_entries=8, show_spinner=False)
+def comparison_df_to_csv(df: pd.DataFrame) -> bytes:
+    """
+    Serializes the comparison table to gzip-compressed CSV bytes, cached so reruns don't re-serialize
+    an unchanged table. Compressing keeps both the cached payload and the download several times smaller.
+    """
+    csv_buffer = BytesIO()
+    df.to_csv(csv_buffer, float_format="%.2f", na_rep="-", compression={"method": "gzip", "compresslevel": 6})
+    return csv_buffer.getvalue()
+
 def render_comparison_table(df: pd.DataFrame):
     """Displays the comparison table and download button."""
     if not df.empty:
         st.subheader("SKU Comparison Table")
-        # Apply styling to the dataframe directly
-        styled_df = df.style.apply(highlight_best_deal, axis=1)
+        # Apply styling to the dataframe directly; numeric cells are formatted here in one pass
+        disc_columns = [col for col in df.columns if col[1] == "Eff. Disc% "]
+        styled_df = (
+            df.style.apply(highlight_best_deal, axis=1, supplier_columns=supplier_column_indices(df.columns))
+            .format(precision=2, na_rep="-")
+            .format("{:.2f} %", subset=disc_columns, na_rep="-")
+        )
         st.dataframe(styled_df, use_container_width=True)
 
         # Download as CSV button (use the original dataframe without styling)
-        csv_buffer = BytesIO()
-        df.to_csv(csv_buffer)
-        csv_buffer.seek(0)
         st.download_button(
-            label="Download Comparison as CSV",
-            data=csv_buffer,
-            file_name="sku_comparison_report.csv",
-            mime="text/csv"
+            label="Download Comparison as CSV (gzip)",
+            data=comparison_df_to_csv(df),
+            file_name="sku_comparison_report.csv.gz",
+            mime="application/gzip"
         )
 
 def render_notes():
@@ -127,11 +139,12 @@ def render_notes():
     *   The 'Best Deal' column indicates the supplier and quantity scheme for the most favorable offer.
     """)
 
-def render_raw_data_expander(raw_data: Optional[List[Dict[str, Any]]]):
-    """Displays the raw extracted JSON data in an expander."""
-    if raw_data:
-        with st.expander("View Raw Extracted JSON Data from Gemini"):
-            st.json(raw_data)
+def render_raw_data_expander(raw_df: Optional[pd.DataFrame]):
+    """Displays the raw extracted data in an expander."""
+    if raw_df is not None and not raw_df.empty:
+        with st.expander("View Raw Extracted Data from Gemini"):
+            # st.dataframe ships the table as Arrow instead of serializing every item to JSON on each rerun
+            st.dataframe(raw_df, use_container_width=True)
 
 def render_footer():
     """Displays the application footer."""